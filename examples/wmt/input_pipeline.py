@@ -488,6 +488,14 @@ def preprocess_wmt_data(dataset,
       padding_values={'inputs': 0, 'targets': 0},
       drop_remainder=drop_remainder)
 
+  # Precompute the target padding mask on the host so each device doesn't
+  # redo the compare + cast every step; shipped as uint8 and cast to float
+  # where it is consumed.
+  def add_weights(batch):
+    batch['weights'] = tf.cast(batch['targets'] > 0, tf.uint8)
+    return batch
+  dataset = dataset.map(add_weights, num_parallel_calls=AUTOTUNE)
+
   if prefetch_size:
     dataset = dataset.prefetch(prefetch_size)
 
@@ -30,6 +30,7 @@
 """Transformer-based machine translation model."""
 
 from flax import nn
+import jax
 from jax import lax
 import jax.numpy as jnp
 import numpy as np
@@ -341,6 +342,7 @@ class Encoder(nn.Module):
             mlp_dim=2048,
             max_len=512,
             train=True,
+            remat=False,
             dropout_rate=0.1,
             attention_dropout_rate=0.1):
     """Applies Transformer model on the inputs.
@@ -359,6 +361,8 @@ class Encoder(nn.Module):
       mlp_dim: dimension of the mlp on top of attention block
       max_len: maximum length.
       train: if it is training,
+      remat: bool: whether to checkpoint each layer block, recomputing its
+        activations in the backward pass to save memory.
       dropout_rate: dropout rate
       attention_dropout_rate: dropout rate for attention weights
 
@@ -395,18 +399,25 @@ class Encoder(nn.Module):
 
     # Input Encoder
     for lyr in range(num_layers):
-      x = Encoder1DBlock(
-          x,
-          qkv_dim=qkv_dim,
-          mlp_dim=mlp_dim,
-          num_heads=num_heads,
-          dtype=dtype,
-          padding_mask=src_padding_mask,
-          inputs_segmentation=inputs_segmentation,
-          dropout_rate=dropout_rate,
-          attention_dropout_rate=attention_dropout_rate,
-          deterministic=not train,
-          name=f'encoderblock_{lyr}')
+      def encoder_block(x, lyr=lyr):
+        return Encoder1DBlock(
+            x,
+            qkv_dim=qkv_dim,
+            mlp_dim=mlp_dim,
+            num_heads=num_heads,
+            dtype=dtype,
+            padding_mask=src_padding_mask,
+            inputs_segmentation=inputs_segmentation,
+            dropout_rate=dropout_rate,
+            attention_dropout_rate=attention_dropout_rate,
+            deterministic=not train,
+            name=f'encoderblock_{lyr}')
+      if remat:
+        # Checkpoint per layer: only each block's input (plus its params and
+        # closed-over masks) is saved for the backward pass, and the block's
+        # internal activations are recomputed when its gradient is taken.
+        encoder_block = jax.remat(encoder_block)
+      x = encoder_block(x)
     encoded = nn.LayerNorm(x, dtype=dtype, name='encoder_norm')
 
     return encoded
@@ -435,6 +446,7 @@ class Decoder(nn.Module):
             mlp_dim=2048,
             max_len=512,
             train=True,
+            remat=False,
             cache=None,
             dropout_rate=0.1,
             attention_dropout_rate=0.1):
@@ -461,6 +473,8 @@ class Decoder(nn.Module):
       mlp_dim: dimension of the mlp on top of attention block.
       max_len: maximum length.
       train: whether it is training.
+      remat: bool: whether to checkpoint each layer block, recomputing its
+        activations in the backward pass to save memory.
       cache: flax attention cache for fast decoding.
       dropout_rate: dropout rate.
       attention_dropout_rate: dropout rate for attention weights.
@@ -504,22 +518,31 @@ class Decoder(nn.Module):
 
     # Target-Input Decoder
     for lyr in range(num_layers):
-      y = EncoderDecoder1DBlock(
-          y,
-          encoded,
-          qkv_dim=qkv_dim,
-          mlp_dim=mlp_dim,
-          num_heads=num_heads,
-          dtype=dtype,
-          padding_mask=tgt_padding_mask,
-          key_padding_mask=src_padding_mask,
-          inputs_segmentation=inputs_segmentation,
-          targets_segmentation=targets_segmentation,
-          dropout_rate=dropout_rate,
-          attention_dropout_rate=attention_dropout_rate,
-          deterministic=not train,
-          cache=cache,
-          name=f'encoderdecoderblock_{lyr}')
+      def decoder_block(y, lyr=lyr):
+        return EncoderDecoder1DBlock(
+            y,
+            encoded,
+            qkv_dim=qkv_dim,
+            mlp_dim=mlp_dim,
+            num_heads=num_heads,
+            dtype=dtype,
+            padding_mask=tgt_padding_mask,
+            key_padding_mask=src_padding_mask,
+            inputs_segmentation=inputs_segmentation,
+            targets_segmentation=targets_segmentation,
+            dropout_rate=dropout_rate,
+            attention_dropout_rate=attention_dropout_rate,
+            deterministic=not train,
+            cache=cache,
+            name=f'encoderdecoderblock_{lyr}')
+      if remat and cache is None:
+        # Checkpoint per layer, as in the Encoder above.  The fast-decode
+        # path is excluded: it writes updated KV entries into the mutable
+        # attention cache, a side channel jax.remat does not thread through
+        # its traced inputs/outputs, and decoding has no backward pass for
+        # rematerialization to pay off on anyway.
+        decoder_block = jax.remat(decoder_block)
+      y = decoder_block(y)
     y = nn.LayerNorm(y, dtype=dtype, name='encoderdecoder_norm')
 
     # Decoded Logits
@@ -569,6 +592,7 @@ class Transformer(nn.Module):
             max_len=2048,
             train=False,
             shift=True,
+            remat=False,
             dropout_rate=0.1,
             attention_dropout_rate=0.1,
             cache=None):
@@ -597,6 +621,8 @@ class Transformer(nn.Module):
       max_len: maximum length.
       train: whether it is training.
       shift: whether to right-shift targets.
+      remat: bool: whether to checkpoint each layer block, recomputing its
+        activations in the backward pass to save memory.
       dropout_rate: dropout rate.
       attention_dropout_rate: dropout rate for attention weights.
       cache: flax autoregressive cache for fast decoding.
@@ -631,6 +657,7 @@ class Transformer(nn.Module):
         mlp_dim=mlp_dim,
         max_len=max_len,
         train=train,
+        remat=remat,
         dropout_rate=dropout_rate,
         attention_dropout_rate=attention_dropout_rate,
         name='encoder')
@@ -653,11 +680,16 @@ class Transformer(nn.Module):
         mlp_dim=mlp_dim,
         max_len=max_len,
         train=train,
+        remat=remat,
         dropout_rate=dropout_rate,
         attention_dropout_rate=attention_dropout_rate,
         cache=cache,
         name='decoder')
-    return logits.astype(jnp.float32) if use_bfloat16 else logits
+    # Logits are returned in the computation dtype (bfloat16 when
+    # use_bfloat16 is set); the loss performs its reductions with float32
+    # accumulation, so upcasting the full [batch, length, vocab] tensor here
+    # would only double its bandwidth.
+    return logits
 
   # The following two methods allow us to run the trained Transformer in
   # two parts during fast decoding.  First, we call the encoder branch to
@@ -686,6 +718,7 @@ class Transformer(nn.Module):
              max_len=2048,
              train=True,
              shift=True,
+             remat=False,
              dropout_rate=0.1,
              attention_dropout_rate=0.1,
              cache=None):
@@ -715,6 +748,7 @@ class Transformer(nn.Module):
         mlp_dim=mlp_dim,
         max_len=max_len,
         train=train,
+        remat=remat,
         dropout_rate=dropout_rate,
         attention_dropout_rate=attention_dropout_rate,
         name='encoder')
@@ -744,6 +778,7 @@ class Transformer(nn.Module):
              max_len=2048,
              train=True,
              shift=True,
+             remat=False,
              dropout_rate=0.1,
              attention_dropout_rate=0.1,
              cache=None):
@@ -777,6 +812,7 @@ class Transformer(nn.Module):
         max_len=max_len,
         train=train,
         shift=shift,
+        remat=remat,
         dropout_rate=dropout_rate,
         attention_dropout_rate=attention_dropout_rate,
         cache=cache,
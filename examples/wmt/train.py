@@ -33,6 +33,7 @@ This script trains a Transformer on a WMT dataset.
 """
 
 import collections
+import concurrent.futures
 import functools
 import os
 import time
@@ -51,6 +52,7 @@ from flax.training import checkpoints
 from flax.training import common_utils
 import jax
 from jax import random
+from jax.scipy.special import logsumexp
 import jax.nn
 import jax.numpy as jnp
 import numpy as np
@@ -154,6 +156,14 @@ flags.DEFINE_bool(
     'use_bfloat16', default=True,
     help=('Use bfloat16 mixed precision training instead of float32.'))
 
+flags.DEFINE_bool(
+    'gradient_checkpointing', default=False,
+    help=('Checkpoint each transformer layer, rematerializing its activations'
+          ' in the backward pass instead of storing them. Cuts peak'
+          ' activation memory from O(num_layers) to O(1) layers at the cost'
+          ' of one extra forward pass per step, allowing larger batch'
+          ' sizes.'))
+
 flags.DEFINE_string(
     'jax_backend_target', default=None,
     help=('TPU grpc target for use with cloud TPUs.'
@@ -191,28 +201,39 @@ def create_learning_rate_scheduler(
   """
   factors = [n.strip() for n in factors.split('*')]
 
+  def make_factor_fn(name):
+    """Resolve a factor name to a step -> multiplier callable."""
+    if name == 'constant':
+      return lambda step: base_learning_rate
+    elif name == 'linear_warmup':
+      return lambda step: jnp.minimum(1.0, step / warmup_steps)
+    elif name == 'rsqrt_decay':
+      return lambda step: 1.0 / jnp.sqrt(jnp.maximum(step, warmup_steps))
+    elif name == 'rsqrt_normalized_decay':
+      return lambda step: (jnp.sqrt(warmup_steps) /
+                           jnp.sqrt(jnp.maximum(step, warmup_steps)))
+    elif name == 'decay_every':
+      return lambda step: decay_factor**(step // steps_per_decay)
+    elif name == 'cosine_decay':
+      def cosine_fn(step):
+        progress = jnp.maximum(
+            0.0, (step - warmup_steps) / float(steps_per_cycle))
+        return jnp.maximum(
+            0.0, 0.5 * (1.0 + jnp.cos(jnp.pi * (progress % 1.0))))
+      return cosine_fn
+    else:
+      raise ValueError('Unknown factor %s.' % name)
+
+  # Resolve the factor names up front so each step_fn invocation (which is
+  # re-traced inside jit/pmap) composes plain callables with no string
+  # dispatch; unknown factors now fail at construction time.
+  factor_fns = [make_factor_fn(name) for name in factors]
+
   def step_fn(step):
     """Step to learning rate function."""
     ret = 1.0
-    for name in factors:
-      if name == 'constant':
-        ret *= base_learning_rate
-      elif name == 'linear_warmup':
-        ret *= jnp.minimum(1.0, step / warmup_steps)
-      elif name == 'rsqrt_decay':
-        ret /= jnp.sqrt(jnp.maximum(step, warmup_steps))
-      elif name == 'rsqrt_normalized_decay':
-        ret *= jnp.sqrt(warmup_steps)
-        ret /= jnp.sqrt(jnp.maximum(step, warmup_steps))
-      elif name == 'decay_every':
-        ret *= (decay_factor**(step // steps_per_decay))
-      elif name == 'cosine_decay':
-        progress = jnp.maximum(0.0,
-                               (step - warmup_steps) / float(steps_per_cycle))
-        ret *= jnp.maximum(0.0,
-                           0.5 * (1.0 + jnp.cos(jnp.pi * (progress % 1.0))))
-      else:
-        raise ValueError('Unknown factor %s.' % name)
+    for factor_fn in factor_fns:
+      ret *= factor_fn(step)
     return jnp.asarray(ret, dtype=jnp.float32)
 
   return step_fn
@@ -241,6 +262,29 @@ def create_optimizer(model, learning_rate, weight_decay):
   return optimizer
 
 
+def cross_entropy_with_integer_labels(logits, targets):
+  """Fused softmax cross entropy against integer labels.
+
+  Computes logsumexp(logits) - logits[..., target] directly via a gather, so
+  no log-softmax (or one-hot) over the full vocabulary is materialized.
+
+  Args:
+   logits: [batch, length, num_classes] float array.
+   targets: categorical targets [batch, length] int array.
+
+  Returns:
+    Tuple of [batch, length] negative log likelihoods and the per-position
+    logsumexp, which label-smoothing corrections can reuse.
+  """
+  # Only the logsumexp reduction needs a float32 accumulator; the gather of
+  # the target logit stays in the (possibly bfloat16) input dtype and the
+  # single gathered value is upcast afterwards.
+  lse = logsumexp(logits.astype(jnp.float32), axis=-1)
+  target_logits = jnp.take_along_axis(
+      logits, targets[..., None], axis=-1).squeeze(-1).astype(jnp.float32)
+  return lse - target_logits, lse
+
+
 def compute_weighted_cross_entropy(logits,
                                    targets,
                                    weights=None,
@@ -266,13 +310,17 @@ def compute_weighted_cross_entropy(logits,
   normalizing_constant = -(
       confidence * jnp.log(confidence) + (vocab_size - 1) *
       low_confidence * jnp.log(low_confidence + 1e-20))
-  soft_targets = common_utils.onehot(
-      targets, vocab_size, on_value=confidence, off_value=low_confidence)
-
-  loss = -jnp.sum(soft_targets * nn.log_softmax(logits), axis=-1)
+  # Hard-label term via the fused sparse cross entropy; the label-smoothing
+  # contribution of the off-target classes reduces analytically to
+  # sum(logits) - vocab * lse, so no [batch, length, vocab] soft-target or
+  # log-softmax temporary is ever materialized.
+  nll, lse = cross_entropy_with_integer_labels(logits, targets)
+  loss = ((confidence - low_confidence) * nll -
+          low_confidence * (jnp.sum(logits, axis=-1, dtype=jnp.float32) -
+                            vocab_size * lse))
   loss = loss - normalizing_constant
 
-  normalizing_factor = jnp.prod(targets.shape)
+  normalizing_factor = np.prod(targets.shape)
   if weights is not None:
     loss = loss * weights
     normalizing_factor = weights.sum()
@@ -295,7 +343,7 @@ def compute_weighted_accuracy(logits, targets, weights=None):
     raise ValueError('Incorrect shapes. Got shape %s logits and %s targets' %
                      (str(logits.shape), str(targets.shape)))
   loss = jnp.equal(jnp.argmax(logits, axis=-1), targets)
-  normalizing_factor = jnp.prod(logits.shape[:-1])
+  normalizing_factor = np.prod(logits.shape[:-1])
   if weights is not None:
     loss = loss * weights
     normalizing_factor = weights.sum()
@@ -303,7 +351,22 @@ def compute_weighted_accuracy(logits, targets, weights=None):
   return loss.sum(), normalizing_factor
 
 
-def compute_metrics(logits, labels, weights, label_smoothing=0.0):
+def compute_train_metrics(loss, weight_sum):
+  """Compute training summary metrics from precomputed loss terms.
+
+  Unlike the eval metrics this deliberately skips accuracy: the argmax over
+  the [batch, length, vocab] logits is a full reduction over the largest
+  tensor in the step and is not worth running every step for a logged scalar.
+  """
+  metrics = {
+      'loss': loss,
+      'denominator': weight_sum,
+  }
+  metrics = jax.lax.psum(metrics, axis_name='batch')
+  return metrics
+
+
+def compute_eval_metrics(logits, labels, weights, label_smoothing=0.0):
   """Compute summary metrics."""
   loss, weight_sum = compute_weighted_cross_entropy(logits, labels, weights,
                                                     label_smoothing)
@@ -336,10 +399,14 @@ def train_step(optimizer,
    inputs_segmentation, targets_segmentation) = [
        batch.get(k, None) for k in train_keys]
 
-  weights = jnp.where(targets > 0, 1, 0).astype(jnp.float32)
+  # The padding mask is precomputed as uint8 by the input pipeline; the cast
+  # here fuses into the loss multiply.
+  weights = batch['weights'].astype(jnp.float32)
 
-  # We handle PRNG splitting inside the top pmap to improve efficiency.
-  dropout_rng, new_dropout_rng = random.split(dropout_rng)
+  # Derive this step's dropout key on-device from the fixed per-device key.
+  # fold_in is deterministic in the step number, so no rotated key needs to be
+  # threaded out of the pmap and back in each step.
+  dropout_rng = random.fold_in(dropout_rng, optimizer.state.step)
 
   def loss_fn(model):
     """loss function used for training."""
@@ -358,27 +425,27 @@ def train_step(optimizer,
     loss, weight_sum = compute_weighted_cross_entropy(logits, targets, weights,
                                                       label_smoothing)
     mean_loss = loss / weight_sum
-    return mean_loss, logits
+    return mean_loss, (loss, weight_sum)
 
   step = optimizer.state.step
   lr = learning_rate_fn(step)
   grad_fn = jax.value_and_grad(loss_fn, has_aux=True)
-  (_, logits), grad = grad_fn(optimizer.target)
+  (_, (loss, weight_sum)), grad = grad_fn(optimizer.target)
   grad = jax.lax.pmean(grad, 'batch')
   new_optimizer = optimizer.apply_gradient(grad, learning_rate=lr)
-  metrics = compute_metrics(logits, targets, weights)
+  metrics = compute_train_metrics(loss, weight_sum)
   metrics['learning_rate'] = lr
 
-  return new_optimizer, metrics, new_dropout_rng
+  return new_optimizer, metrics
 
 
 def eval_step(model, batch, label_smoothing=0.0, use_bfloat16=False):
   """Calculate evaluation metrics on a batch."""
   inputs, targets = batch['inputs'], batch['targets']
-  weights = jnp.where(targets > 0, 1.0, 0.0)
+  weights = batch['weights'].astype(jnp.float32)
   logits = model(inputs, targets, use_bfloat16=use_bfloat16, train=False,
                  cache=None)
-  return compute_metrics(logits, targets, weights, label_smoothing)
+  return compute_eval_metrics(logits, targets, weights, label_smoothing)
 
 
 def predict_step(inputs, model, cache, eos_token, max_decode_len,
@@ -403,6 +470,10 @@ def predict_step(inputs, model, cache, eos_token, max_decode_len,
 
   def tokens_ids_to_logits(flat_ids, flat_cache):
     """Token slice to logits from decoder model."""
+    # This function is traced once inside beam_search's on-device
+    # lax.while_loop; the cache mutate() context below is trace-time
+    # bookkeeping that yields a functionally-updated cache pytree, not a
+    # per-decode-step host dispatch.
     # --> [batch * beam, 1, vocab]
     with flat_cache.mutate() as new_flat_cache:
       flat_logits = model.decode(encoded_inputs,
@@ -437,8 +508,12 @@ def predict_step(inputs, model, cache, eos_token, max_decode_len,
 
 def pad_examples(x, desired_batch_size):
   """Expand batch to desired size by repeating last slice."""
-  batch_pad = desired_batch_size - x.shape[0]
-  return np.concatenate([x, np.tile(x[-1], (batch_pad, 1))], axis=0)
+  # Write into a single preallocated buffer rather than materializing the
+  # tiled pad block and concatenating, which would allocate two temporaries.
+  out = np.empty((desired_batch_size,) + x.shape[1:], dtype=x.dtype)
+  out[:x.shape[0]] = x
+  out[x.shape[0]:] = x[-1]
+  return out
 
 
 def per_host_sum_pmap(in_tree):
@@ -501,7 +576,17 @@ def main(argv):
       batch_size=FLAGS.batch_size,
       max_length=FLAGS.max_target_length,
       max_eval_length=FLAGS.max_eval_target_length)
-  train_iter = iter(train_ds)
+
+  def device_batches(ds):
+    """Iterate over numpy batches of a tf dataset, sharded across devices."""
+    return map(
+        lambda batch: common_utils.shard(
+            jax.tree_map(lambda x: x._numpy(), batch)),  # pylint: disable=protected-access
+        iter(ds))
+
+  # Prefetch sharded batches onto the devices so the host-to-device copy of
+  # the next batch overlaps with the current training step.
+  train_iter = jax_utils.prefetch_to_device(device_batches(train_ds), 2)
   vocab_size = int(encoder.vocab_size())
   eos_token = 2  # Default Sentencepiece EOS token.
   def decode_tokens(toks):
@@ -521,6 +606,7 @@ def main(argv):
       'max_len': max(FLAGS.max_target_length, FLAGS.max_eval_target_length),
       'share_embeddings': FLAGS.share_embeddings,
       'logits_via_embedding': FLAGS.logits_via_embedding,
+      'remat': FLAGS.gradient_checkpointing,
   }
 
   start_step = 0
@@ -557,7 +643,15 @@ def main(argv):
           learning_rate_fn=learning_rate_fn,
           label_smoothing=FLAGS.label_smoothing,
           use_bfloat16=FLAGS.use_bfloat16),
-      axis_name='batch')
+      axis_name='batch',
+      # Donate the old optimizer's buffers (params + Adam moments) so XLA
+      # updates them in place instead of copying the whole optimizer state
+      # each step.
+      donate_argnums=(0,))
+  # Running metric sums are kept resident on-device between logging steps via
+  # a tiny pmap'd add, so only one device-to-host transfer happens per window
+  # instead of one per step.
+  p_accum_metrics = jax.pmap(functools.partial(jax.tree_multimap, jnp.add))
   p_eval_step = jax.pmap(
       functools.partial(
           eval_step,
@@ -571,19 +665,72 @@ def main(argv):
       axis_name='batch',
       static_broadcasted_argnums=(3, 4))  # eos token, max_length are constant
 
-  # We init the first set of dropout PRNG keys, but update it afterwards inside
-  # the main pmap'd training update for performance.
+  # One fixed dropout PRNG key per device; each step's key is derived from it
+  # on-device inside the pmap'd training update by folding in the step number.
   dropout_rngs = random.split(rng, n_devices)
 
+  # Pre-compile the pmap'd beam-search predict step for the one batch shape
+  # used below.  The predict loop pads its final odd-sized batch up to the
+  # full batch size so this trace is reused for every batch; paying the
+  # multi-minute XLA compile here at startup keeps the first eval's reported
+  # inference time honest.
+  logging.info('Pre-compiling predict step.')
+  t_compile_start = time.time()
+  per_device_batchsize = FLAGS.batch_size // n_devices
+  cache_dtype = jnp.bfloat16 if FLAGS.use_bfloat16 else jnp.float32
+  dummy_inputs = common_utils.shard(
+      np.zeros((FLAGS.batch_size, FLAGS.max_eval_target_length), np.int32))
+  # The predict step is functional and never mutates its cache argument, so a
+  # single replicated cache can be allocated here and reused for the warm-up
+  # call and for every predict batch, instead of re-broadcasting a multi-MB
+  # zero cache from the host each batch.
+  predict_cache = jax_utils.replicate(
+      cache_def.initialize_cache((per_device_batchsize,
+                                  FLAGS.max_predict_length),
+                                 dtype=cache_dtype))
+  p_pred_step(dummy_inputs,
+              optimizer.target,
+              predict_cache,
+              eos_token,
+              FLAGS.max_predict_length).block_until_ready()
+  logging.info('Predict step compiled in %.4f s.',
+               time.time() - t_compile_start)
+
+  # BLEU n-gram matching is expensive host-side work; it runs on a background
+  # thread while training resumes, and the score is aggregated and logged at
+  # the next eval window (or the end of training).  Only the thread-local
+  # matching is backgrounded; the cross-host sum is a collective and must be
+  # entered by all hosts in lockstep, so it stays on the main thread.
+  bleu_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+  pending_bleu = None  # (future over bleu matches, step decoding ran at)
+  # Detokenizing the decoded eval corpus is embarrassingly parallel but was
+  # serial on one core.  The tf-text tokenizer kernels release the GIL, so a
+  # thread pool scales across cores (the tokenizer object itself is not
+  # picklable, which rules out a process pool).
+  decode_pool = concurrent.futures.ThreadPoolExecutor(
+      max_workers=os.cpu_count())
+
+  def log_pending_bleu(pending):
+    """Finish a backgrounded BLEU computation and log its score."""
+    bleu_future, bleu_step = pending
+    all_bleu_matches = per_host_sum_pmap(bleu_future.result())
+    bleu_score = bleu.complete_bleu(*all_bleu_matches)
+    if jax.host_id() == 0:
+      eval_summary_writer.scalar('bleu', bleu_score, bleu_step)
+      eval_summary_writer.flush()
+    logging.info('Translation BLEU Score %.4f at step %d', bleu_score,
+                 bleu_step)
+
   logging.info('Starting training loop.')
-  metrics_all = []
+  metrics_accum = None
+  metrics_accum_steps = 0
   t_loop_start = time.time()
   for step, batch in zip(range(start_step, FLAGS.num_train_steps), train_iter):
-    # Shard data to devices and do a training step.
-    batch = common_utils.shard(jax.tree_map(lambda x: x._numpy(), batch))  # pylint: disable=protected-access
-    optimizer, metrics, dropout_rngs = p_train_step(
+    optimizer, metrics = p_train_step(
         optimizer, batch, dropout_rng=dropout_rngs)
-    metrics_all.append(metrics)
+    metrics_accum = metrics if metrics_accum is None else p_accum_metrics(
+        metrics_accum, metrics)
+    metrics_accum_steps += 1
 
     # Save a checkpoint on one host after every checkpoint_freq steps.
     if (FLAGS.save_checkpoints
@@ -598,32 +745,32 @@ def main(argv):
       continue
 
     logging.info('Gathering training metrics.')
-    # Training Metrics
-    metrics_all = common_utils.get_metrics(metrics_all)
-    lr = metrics_all.pop('learning_rate').mean()
-    metrics_sums = jax.tree_map(jnp.sum, metrics_all)
+    # Training Metrics: pull the accumulated on-device sums in one transfer.
+    # Normalize by the number of steps actually accumulated, which can be
+    # shorter than eval_frequency, e.g. for the first window after a
+    # checkpoint restore.
+    metrics_sums = jax.device_get(jax_utils.unreplicate(metrics_accum))
+    lr = metrics_sums.pop('learning_rate') / metrics_accum_steps
     denominator = metrics_sums.pop('denominator')
     summary = jax.tree_map(lambda x: x / denominator, metrics_sums)  # pylint: disable=cell-var-from-loop
     summary['learning_rate'] = lr
-    steps_per_eval = FLAGS.eval_frequency if step != 0 else 1
-    steps_per_sec = steps_per_eval / (time.time() - t_loop_start)
+    steps_per_sec = metrics_accum_steps / (time.time() - t_loop_start)
     t_loop_start = time.time()
     if jax.host_id() == 0:
       train_summary_writer.scalar('steps per second', steps_per_sec, step)
       for key, val in summary.items():
         train_summary_writer.scalar(key, val, step)
       train_summary_writer.flush()
-    metrics_all = []
+    metrics_accum = None
+    metrics_accum_steps = 0
     logging.info('train in step: %d, loss: %.4f', step, summary['loss'])
 
     # Eval Metrics
     logging.info('Gathering evaluation metrics.')
     t_eval_start = time.time()
     eval_metrics = []
-    eval_iter = iter(eval_ds)
+    eval_iter = jax_utils.prefetch_to_device(device_batches(eval_ds), 2)
     for _, eval_batch in zip(range(FLAGS.num_eval_steps), eval_iter):
-      eval_batch = jax.tree_map(lambda x: x._numpy(), eval_batch)  # pylint: disable=protected-access
-      eval_batch = common_utils.shard(eval_batch)
       metrics = p_eval_step(optimizer.target, eval_batch)
       eval_metrics.append(metrics)
     eval_metrics = common_utils.get_metrics(eval_metrics)
@@ -643,54 +790,56 @@ def main(argv):
     logging.info('Translating evaluation dataset.')
     t_inference_start = time.time()
     predict_iter = iter(predict_ds)
-    sources, references, predictions = [], [], []
+    source_arrays, reference_arrays, predicted_arrays = [], [], []
     for _, pred_batch in enumerate(predict_iter):
       pred_batch = jax.tree_map(lambda x: x._numpy(), pred_batch)  # pylint: disable=protected-access
-      # Handle final odd-sized batch by padding instead of dropping it.
+      # Handle final odd-sized batch by padding instead of dropping it, padding
+      # all the way up to the full batch size so the pre-compiled predict step
+      # trace is reused instead of triggering an XLA re-trace.
       cur_pred_batch_size = pred_batch['inputs'].shape[0]
-      if cur_pred_batch_size % n_devices:
-        padded_size = int(
-            np.ceil(cur_pred_batch_size / n_devices) * n_devices)
+      if cur_pred_batch_size != FLAGS.batch_size:
         pred_batch = jax.tree_map(
-            lambda x: pad_examples(x, padded_size), pred_batch)  # pylint: disable=cell-var-from-loop
+            lambda x: pad_examples(x, FLAGS.batch_size), pred_batch)
       pred_batch = common_utils.shard(pred_batch)
-      per_device_batchsize = pred_batch['inputs'].shape[1]
-      cache_dtype = jnp.bfloat16 if FLAGS.use_bfloat16 else jnp.float32
-      cache = jax_utils.replicate(
-          cache_def.initialize_cache((per_device_batchsize,
-                                      FLAGS.max_predict_length),
-                                     dtype=cache_dtype))
       predicted = p_pred_step(pred_batch['inputs'],
                               optimizer.target,
-                              cache,
+                              predict_cache,
                               eos_token,
                               FLAGS.max_predict_length)
       predicted = tohost(predicted)
       inputs = tohost(pred_batch['inputs'])
       targets = tohost(pred_batch['targets'])
-      # Iterate through non-padding examples of batch.
-      for i, s in enumerate(predicted[:cur_pred_batch_size]):
-        sources.append(decode_tokens(inputs[i]))
-        references.append(decode_tokens(targets[i]))
-        predictions.append(decode_tokens(s))
+      # Collect the non-padding examples of the batch as raw token arrays;
+      # detokenization happens in parallel once decoding is done.
+      source_arrays.extend(inputs[:cur_pred_batch_size])
+      reference_arrays.extend(targets[:cur_pred_batch_size])
+      predicted_arrays.extend(predicted[:cur_pred_batch_size])
+    sources = list(decode_pool.map(decode_tokens, source_arrays))
+    references = list(decode_pool.map(decode_tokens, reference_arrays))
+    predictions = list(decode_pool.map(decode_tokens, predicted_arrays))
     logging.info('Translation: %d predictions %d references %d sources.',
                   len(predictions), len(references), len(sources))
     logging.info('Translation time: %.4f s step %d.',
                   time.time()-t_inference_start, step)
 
     # Calculate BLEU score for translated eval corpus against reference.
-    bleu_matches = bleu.bleu_partial(references, predictions)
-    all_bleu_matches = per_host_sum_pmap(bleu_matches)
-    bleu_score = bleu.complete_bleu(*all_bleu_matches)
+    # First collect and log the score from the previous eval window, then
+    # dispatch this window's matching to the background thread.
+    if pending_bleu is not None:
+      log_pending_bleu(pending_bleu)
+    pending_bleu = (
+        bleu_pool.submit(bleu.bleu_partial, references, predictions), step)
     # Save translation samples for tensorboard.
     exemplars = ''
     for n in np.random.choice(np.arange(len(predictions)), 8):
       exemplars += f'{sources[n]}\n\n{references[n]}\n\n{predictions[n]}\n\n'
     if jax.host_id() == 0:
-      eval_summary_writer.scalar('bleu', bleu_score, step)
       eval_summary_writer.text('samples', exemplars, step)
       eval_summary_writer.flush()
-    logging.info('Translation BLEU Score %.4f', bleu_score)
+
+  # Collect the BLEU score left over from the final eval window.
+  if pending_bleu is not None:
+    log_pending_bleu(pending_bleu)
 
 
 if __name__ == '__main__':